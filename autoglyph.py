@@ -7,20 +7,50 @@ Automatically analyzes note content and assigns thematic glyphs using local LLMs
 """
 
 from pathlib import Path
-import frontmatter
-from llama_cpp import Llama
+from concurrent.futures import ThreadPoolExecutor
+from llama_cpp import LLAMA_SPLIT_MODE_LAYER, LLAMA_SPLIT_MODE_NONE, Llama, LlamaGrammar
+import argparse
+import asyncio
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import queue
 import time
 import datetime
+import functools
 import json
+import orjson
 import yaml
-from typing import List, Dict, Optional
+from typing import BinaryIO, Iterable, Iterator, List, Dict, NamedTuple, Optional, Tuple
 
 # ======================
 # CONFIGURATION
 # ======================
 VAULT_PATH = Path(r"VAULT PATH HERE")
 LOG_FILE = VAULT_PATH / "glyph_assignments.jsonl"  # JSON Lines format
-MODEL_PATH = r"LOCAL LLM MODEL HERE"
+CACHE_FILE = VAULT_PATH / "glyph_cache.json"  # Glyphs by note content hash, reused across runs
+CACHE_MAX_ENTRIES = 4096  # Most recently used assignments kept in CACHE_FILE
+MODEL_PATH = r"LOCAL LLM MODEL HERE"  # Q4_K_M / Q5_K_M .gguf recommended
+N_GPU_LAYERS = -1  # -1 offloads every layer; lower it if VRAM runs out
+PROMPT_MEANINGS = 3  # Meanings per glyph included in the system prompt
+MAX_NOTE_BYTES = 12000  # UTF-8 bytes of note text considered for analysis
+MAX_USER_TOKENS = 768  # Token cap on note text sent to the LLM (~3000 English chars)
+TEMPERATURE = 0.3  # Lower = more deterministic
+MAX_OUTPUT_TOKENS = 32  # Grammar already bounds output; multi-token glyphs need headroom
+EXCLUDE_DIRS = {".obsidian", ".trash", ".git"}  # Vault folders never scanned for notes
+MIN_NOTE_BYTES = 50  # Smaller files cannot hold the 50 characters analysis needs
+FRONTMATTER_PEEK_BYTES = 4096  # Bytes checked for an existing glyphstream before parsing
+BATCH_SIZE = 8  # Notes analyzed together before results are written
+LLM_INSTANCES = 1  # Llama instances decoding a batch in parallel; each is a full model copy
+NOTE_QUEUE_SIZE = 64  # Loaded notes buffered ahead of the analyzer
+LOG_BUFFER_BYTES = 1 << 16  # Write buffer for the log handle kept open during a run
+SHARD_WORKERS = 1  # Processes splitting the vault, each loading LLM_INSTANCES models
+NUM_GPUS = 1  # With >1, each shard worker is pinned to one GPU, round-robin
 
 # ======================
 # GLYPH LEXICON
@@ -70,31 +100,147 @@ GLYPH_LEXICON = {
     }
 }
 
+# Per-glyph frontmatter block, built once since the lexicon never changes at runtime
+GLYPH_META_CACHE = {
+    glyph: {
+        "name": data["name"],
+        "meanings": data["meanings"],
+        "archetypes": data["archetypes"],
+        "requires_permission": data["requires_permission"]
+    } for glyph, data in GLYPH_LEXICON.items()
+}
+# Longest first so a glyph that prefixes another can never shadow it
+_GLYPH_RE = re.compile("|".join(re.escape(g) for g in sorted(GLYPH_LEXICON, key=len, reverse=True)))
+MAX_GLYPHS = {True: 3, False: 7}  # Per stream type: personal / shared
+_PERMISSION_GLYPHS = frozenset(g for g, data in GLYPH_LEXICON.items() if data["requires_permission"])
+
 # ======================
 # CORE FUNCTIONS
 # ======================
-def initialize_llm() -> Llama:
-    """Initialize the LLM with configured settings"""
+def initialize_llm(main_gpu: Optional[int] = None) -> Llama:
+    """Initialize the LLM with configured settings; main_gpu pins the whole model to one GPU"""
+    # Layer split (the default) spreads the model over every GPU and ignores main_gpu
+    split_mode = LLAMA_SPLIT_MODE_LAYER if main_gpu is None else LLAMA_SPLIT_MODE_NONE
+    # Llama reuses the longest common token prefix with its last prompt, so the
+    # constant system prompt is not prefilled again for every note
     return Llama(
         model_path=MODEL_PATH,
+        split_mode=split_mode,
+        main_gpu=main_gpu or 0,
         n_ctx=4096,
         n_threads=8,
-        n_gpu_layers=40,
+        n_gpu_layers=N_GPU_LAYERS,
+        flash_attn=True,
+        use_mmap=True,
+        use_mlock=True,  # Keep weights resident instead of paging them back in
         verbose=False
     )
 
-def log_assignment(filename: str, glyphs: List[str], action: str, error: Optional[str] = None):
-    """Log processing results in JSON Lines format"""
+def initialize_llm_pool(size: int = LLM_INSTANCES, main_gpu: Optional[int] = None) -> "queue.Queue[Llama]":
+    """Load Llama instances that worker threads can check out (one full model load each)"""
+    pool = queue.Queue()
+    for _ in range(max(1, size)):
+        pool.put(initialize_llm(main_gpu))
+    return pool
+
+# libyaml's C emitter is much faster; fall back to the pure-Python one if unavailable
+_YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+_YAML_WIDTH = 2**31 - 1  # Never wrap lines (libyaml needs an int, not float("inf"))
+
+def log_assignment(log: BinaryIO, run_id: str, filename: str, glyphs: List[str], action: str, error: Optional[str] = None):
+    """Log processing results in JSON Lines format to an open binary log handle"""
     entry = {
-        "timestamp": datetime.datetime.now().isoformat(),
+        "timestamp": datetime.datetime.now(),  # orjson emits ISO 8601 itself
         "file": filename,
         "action": action,
         "glyphs": glyphs,
-        "run_id": datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+        "run_id": run_id,
         "error": error
     }
-    with open(LOG_FILE, "a", encoding="utf-8") as log:
-        log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    log.write(orjson.dumps(entry) + b"\n")
+
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# Opening "---" line, YAML block, closing "---" line, as Obsidian writes them
+_FRONTMATTER_RE = re.compile(rb"---[ \t]*\r?\n(.*?)^---[ \t]*(?:\r?\n|\Z)", re.DOTALL | re.MULTILINE)
+
+class Note(NamedTuple):
+    """Parsed frontmatter plus the start of the note body"""
+    path: Path
+    metadata: dict
+    content: str  # First MAX_NOTE_BYTES of the body, enough for analysis
+    body_offset: int  # Byte offset where the full body starts, for read_note_body
+    mtime_ns: int  # File state when read; body_offset is only valid while these match
+    size: int
+
+def read_note(md_file: Path) -> Note:
+    """Parse a note's frontmatter through mmap without reading the whole file into memory"""
+    with open(md_file, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:  # mmap cannot map empty files
+            return Note(md_file, {}, "", 0, st.st_mtime_ns, 0)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 3 if mm[:3] == b"\xef\xbb\xbf" else 0  # Skip a UTF-8 BOM
+            metadata, body_offset = {}, start
+            match = _FRONTMATTER_RE.match(mm, start)
+            if match:
+                metadata = yaml.load(match.group(1), Loader=_YAML_LOADER) or {}
+                if not isinstance(metadata, dict):
+                    raise ValueError("frontmatter is not a YAML mapping")
+                body_offset = match.end()
+            excerpt = mm[body_offset:body_offset + MAX_NOTE_BYTES].decode("utf-8", errors="ignore")
+    return Note(md_file, metadata, excerpt.strip(), body_offset, st.st_mtime_ns, st.st_size)
+
+def note_changed(note: Note) -> bool:
+    """Whether the file was modified since the note was read"""
+    st = os.stat(note.path)
+    return (st.st_mtime_ns, st.st_size) != (note.mtime_ns, note.size)
+
+def read_note_body(note: Note) -> str:
+    """Read the complete body of a note, e.g. to write it back unchanged"""
+    with open(note.path, "rb") as f:
+        f.seek(note.body_offset)
+        return f.read().decode("utf-8")
+
+def replace_file(file_path: Path, data: bytes):
+    """
+    Atomically replace file_path with data via a synced sibling temp file
+    Keeps the existing file's mode and (where permitted) ownership
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        st = None
+    
+    if st is not None and st.st_nlink > 1:
+        # Renaming over the path would split it from its other hard links; rewrite in place
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return
+    
+    tmp_path = file_path.with_suffix(file_path.suffix + ".tmp")
+    # Create with the note's own mode (never wider), so private notes are not exposed
+    # while being written; O_EXCL refuses to reuse or follow an existing temp file
+    fd = os.open(
+        tmp_path,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+        st.st_mode & 0o7777 if st is not None else 0o666
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())  # Data must be on disk before the rename makes it visible
+        if st is not None:
+            shutil.copymode(file_path, tmp_path)
+            if hasattr(os, "chown"):
+                try:
+                    os.chown(tmp_path, st.st_uid, st.st_gid)
+                except OSError:
+                    pass  # Only privileged users may hand files to another owner
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
 def write_obsidian_file(file_path: Path, metadata: dict, content: str) -> bool:
     """
@@ -105,156 +251,448 @@ def write_obsidian_file(file_path: Path, metadata: dict, content: str) -> bool:
         # Prepare metadata for YAML dumping
         safe_metadata = {}
         for key, value in metadata.items():
-            if isinstance(value, (str, int, float, bool, list)):
-                safe_metadata[key] = value
+            if isinstance(value, Path):
+                safe_metadata[key] = str(value)
+            elif isinstance(value, tuple):
+                safe_metadata[key] = list(value)  # Avoid python/tuple tags
             else:
-                # Convert complex objects to YAML-safe format
-                safe_metadata[key] = yaml.safe_load(yaml.safe_dump(value, allow_unicode=True))
+                # dicts, dates and scalars are emitted by yaml.dump as-is
+                safe_metadata[key] = value
         
-        # Write to file with proper formatting
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write('---\n')
-            yaml.dump(
-                safe_metadata,
-                f,
-                allow_unicode=True,
-                sort_keys=False,
-                default_flow_style=False,
-                width=float("inf")
-            )
-            f.write('---\n\n')
-            f.write(content.strip())
+        # Build the whole document in memory
+        buf = io.StringIO()
+        buf.write('---\n')
+        yaml.dump(
+            safe_metadata,
+            buf,
+            Dumper=_YAML_DUMPER,
+            allow_unicode=True,
+            sort_keys=False,
+            default_flow_style=False,
+            width=_YAML_WIDTH
+        )
+        buf.write('---\n\n')
+        buf.write(content.strip())
+        
+        replace_file(file_path, buf.getvalue().encode('utf-8'))
         return True
     except Exception as e:
         print(f"File write error for {file_path}: {str(e)}")
         return False
 
 def generate_glyph_prompt(is_personal_stream: bool = True) -> str:
-    """Generate the LLM prompt dynamically based on glyph lexicon"""
-    glyph_descriptions = []
-    for glyph, data in GLYPH_LEXICON.items():
-        desc = f"{glyph} ({data['name']}): {', '.join(data['meanings'])}"
-        if data["requires_permission"]:
-            desc += " [REQUIRES PERMISSION]"
-        glyph_descriptions.append(desc)
-    
-    rules = """Rules:
-- Max 3 glyphs for personal streams
-- Max 7 glyphs for shared experiences
-- Permission glyphs (⧖, ⁂) required for shared streams"""
+    """Generate a compact LLM prompt from the glyph lexicon for one stream type"""
+    # Leading meanings only: names and archetypes repeat them and cost prefill tokens
+    glyph_lines = "\n".join(
+        f"{glyph} {', '.join(data['meanings'][:PROMPT_MEANINGS])}"
+        for glyph, data in GLYPH_LEXICON.items()
+    )
     
-    return f"""Analyze the text and select the most representative glyphs:
+    rule = f"Choose 1-{MAX_GLYPHS[is_personal_stream]} glyphs."
+    if not is_personal_stream:
+        permission_glyphs = ", ".join(g for g, data in GLYPH_LEXICON.items() if data["requires_permission"])
+        rule += f" Include at least one of {permission_glyphs}."
     
-Available Glyphs:
-{" | ".join(glyph_descriptions)}
+    return f"""Pick the glyphs that best fit the text.
+{glyph_lines}
+{rule} Reply with the glyphs only, comma-separated."""
 
-{rules}
+# Built once: an identical prefix on every call lets llama.cpp skip its prefill
+SYSTEM_PROMPTS = {
+    True: generate_glyph_prompt(True),
+    False: generate_glyph_prompt(False)
+}
+
+def _grammar_alternatives(glyphs: Iterable[str]) -> str:
+    return " | ".join(f'"{glyph}"' for glyph in glyphs)
+
+def _grammar_tail(count: int) -> str:
+    """Up to count more comma-separated glyphs"""
+    # Nested optionals rather than {m,n} so older llama.cpp grammar parsers accept it
+    tail = ""
+    for _ in range(count):
+        tail = f'("," glyph{" " + tail if tail else ""})?'
+    return tail
+
+def build_glyph_grammar(max_glyphs: int, require_permission: bool = False) -> str:
+    """GBNF grammar accepting 1..max_glyphs lexicon glyphs separated by commas"""
+    rules = [f"glyph ::= {_grammar_alternatives(GLYPH_LEXICON)}"]
+    if not require_permission:
+        root = " ".join(filter(None, ["glyph", _grammar_tail(max_glyphs - 1)]))
+    else:
+        # Some plain glyphs, then the first permission glyph, then anything up to max_glyphs
+        plain_glyphs = [g for g in GLYPH_LEXICON if g not in _PERMISSION_GLYPHS]
+        alternatives = []
+        for leading in range(max_glyphs if plain_glyphs else 1):
+            parts = ['plain ","'] * leading + ["permission", _grammar_tail(max_glyphs - 1 - leading)]
+            alternatives.append(" ".join(filter(None, parts)))
+        root = " | ".join(f"({alt})" for alt in alternatives)
+        rules.append(f"permission ::= {_grammar_alternatives(g for g in GLYPH_LEXICON if g in _PERMISSION_GLYPHS)}")
+        if plain_glyphs:
+            rules.append(f"plain ::= {_grammar_alternatives(plain_glyphs)}")
+    return "\n".join([f"root ::= {root}"] + rules) + "\n"
+
+# Constrains decoding to valid glyph lists, so output is always parseable
+GLYPH_GRAMMARS = {
+    # Shared streams are only valid with a permission glyph, so make the sampler produce one
+    is_personal: build_glyph_grammar(MAX_GLYPHS[is_personal], require_permission=not is_personal)
+    for is_personal in (True, False)
+}
 
-Return ONLY the chosen glyphs as comma-separated characters."""
+# Content hash -> glyphs in least- to most-recently-used order, so duplicate
+# notes (templates, stubs) skip inference
+_ASSIGNMENT_CACHE: Dict[str, List[str]] = {}
+
+@functools.lru_cache(maxsize=None)
+def model_fingerprint() -> str:
+    """Identify the model file, so swapping models invalidates cached assignments"""
+    try:
+        st = os.stat(MODEL_PATH)
+        return f"{os.path.abspath(MODEL_PATH)}:{st.st_size}:{st.st_mtime_ns}"
+    except OSError:
+        return MODEL_PATH
+
+def content_hash(text: str, is_personal_stream: bool = True) -> str:
+    """Hash the analyzed text together with the model, settings and prompt that produce glyphs"""
+    prompt_input = "\0".join((
+        model_fingerprint(),
+        f"{TEMPERATURE}:{MAX_USER_TOKENS}:{MAX_OUTPUT_TOKENS}",
+        SYSTEM_PROMPTS[is_personal_stream],
+        text
+    ))
+    return hashlib.blake2b(prompt_input.encode("utf-8"), digest_size=16).hexdigest()
+
+def get_cached_assignment(key: str) -> Optional[List[str]]:
+    """Look up cached glyphs, marking the entry as recently used"""
+    glyphs = _ASSIGNMENT_CACHE.pop(key, None)
+    if glyphs is not None:
+        _ASSIGNMENT_CACHE[key] = glyphs
+    return glyphs
+
+def load_assignment_cache():
+    """Load cached glyph assignments from previous runs"""
+    try:
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            _ASSIGNMENT_CACHE.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable glyph cache {CACHE_FILE}: {str(e)}")
 
-def validate_glyphstream(glyphs: List[str], is_personal: bool = True) -> List[str]:
-    """Validate and filter glyph assignments based on rules"""
-    valid_glyphs = [g.strip() for g in glyphs if g.strip() in GLYPH_LEXICON]
+def save_assignment_cache():
+    """Persist the most recently used glyph assignments for the next run"""
+    recent = dict(list(_ASSIGNMENT_CACHE.items())[-CACHE_MAX_ENTRIES:])
+    try:
+        replace_file(CACHE_FILE, json.dumps(recent, ensure_ascii=False).encode("utf-8"))
+    except OSError as e:
+        print(f"Glyph cache write error for {CACHE_FILE}: {str(e)}")
+
+def validate_glyphstream(raw_output: str, is_personal: bool = True) -> List[str]:
+    """Extract lexicon glyphs from LLM output and filter them based on rules"""
+    # The grammar allows repeats; keep the first occurrence of each glyph, in order
+    valid_glyphs = list(dict.fromkeys(_GLYPH_RE.findall(raw_output)))
     
     # Enforce permission rules for shared streams
-    if not is_personal:
-        permission_glyphs = {g for g, data in GLYPH_LEXICON.items() if data["requires_permission"]}
-        if not any(g in permission_glyphs for g in valid_glyphs):
-            return []
+    if not is_personal and _PERMISSION_GLYPHS.isdisjoint(valid_glyphs):
+        return []
     
     # Enforce maximum glyph count
-    max_glyphs = 3 if is_personal else 7
-    return valid_glyphs[:max_glyphs]
+    return valid_glyphs[:MAX_GLYPHS[is_personal]]
+
+# (id(llm), is_personal) -> tokenized prompt prefix and suffix, tokenized once per model
+_PROMPT_TOKENS: Dict[Tuple[int, bool], Tuple[List[int], List[int]]] = {}
+
+def build_prompt_tokens(llm: Llama, text: str, is_personal_stream: bool = True) -> List[int]:
+    """Token ids for system prefix + capped note text + answer cue"""
+    key = (id(llm), is_personal_stream)
+    if key not in _PROMPT_TOKENS:
+        prefix = f"{SYSTEM_PROMPTS[is_personal_stream]}\n\nText to analyze:\n\n"
+        _PROMPT_TOKENS[key] = (
+            llm.tokenize(prefix.encode("utf-8")),
+            llm.tokenize(b"\n\nGlyphs:", add_bos=False)
+        )
+    prefix_tokens, suffix_tokens = _PROMPT_TOKENS[key]
+    user_tokens = llm.tokenize(text.encode("utf-8"), add_bos=False)[:MAX_USER_TOKENS]
+    return prefix_tokens + user_tokens + suffix_tokens
 
 def llm_assign_glyphs(llm: Llama, text: str, is_personal_stream: bool = True) -> List[str]:
     """Get glyph assignments from LLM with error handling"""
     if len(text) < 50:  # Skip very short notes
         return []
     
+    # Bound by bytes, not characters, and drop any codepoint cut at the boundary
+    text = text.encode("utf-8")[:MAX_NOTE_BYTES].decode("utf-8", errors="ignore")
+    key = content_hash(text, is_personal_stream)
+    cached = get_cached_assignment(key)
+    if cached is not None:
+        return list(cached)
+    
     try:
-        response = llm.create_chat_completion(
-            messages=[{
-                "role": "system",
-                "content": generate_glyph_prompt(is_personal_stream)
-            }, {
-                "role": "user",
-                "content": f"Text to analyze:\n\n{text[:3000]}"  # First 3000 chars
-            }],
-            temperature=0.3,  # Lower = more deterministic
-            max_tokens=20
+        # Constant system prefix first, per-note text last
+        prompt = build_prompt_tokens(llm, text, is_personal_stream)
+        # Grammar state is mutated while sampling, so parse a fresh one per call
+        grammar = LlamaGrammar.from_string(GLYPH_GRAMMARS[is_personal_stream], verbose=False)
+        response = llm.create_completion(
+            prompt=prompt,
+            temperature=TEMPERATURE,
+            max_tokens=MAX_OUTPUT_TOKENS,
+            stop=["\n"],
+            grammar=grammar
         )
         
-        raw_output = response['choices'][0]['message']['content'].strip()
-        return validate_glyphstream(raw_output.split(","), is_personal_stream)
+        glyphstream = validate_glyphstream(response['choices'][0]['text'], is_personal_stream)
+        if glyphstream:  # Leave misses uncached so they are retried next time
+            _ASSIGNMENT_CACHE[key] = glyphstream
+        return list(glyphstream)
     except Exception as e:
         print(f"LLM processing error: {str(e)}")
         return []
 
+def analyze_note(llm_pool: "queue.Queue[Llama]", note: Note, throttle_ms: int = 0) -> Tuple[List[str], bool]:
+    """Borrow an LLM from the pool and assign glyphs to a single note"""
+    # Determine stream type
+    is_personal = "shared_experience" not in note.metadata.get("tags", [])
+    llm = llm_pool.get()
+    try:
+        glyphstream = llm_assign_glyphs(llm, note.content, is_personal)
+        if throttle_ms > 0:
+            time.sleep(throttle_ms / 1000)  # Optional back-pressure (e.g. thermals)
+        return glyphstream, is_personal
+    finally:
+        llm_pool.put(llm)
+
+def record_glyphs(md_file: Path, note: Note, glyphstream: List[str], is_personal: bool) -> str:
+    """Write assigned glyphs back into the note and return the log action"""
+    if not glyphstream:
+        return "NO_MATCH"
+    
+    # Edited while queued (e.g. in Obsidian): body_offset is stale, so start from the current file
+    if note_changed(note):
+        note = read_note(md_file)
+        if 'glyphstream' in note.metadata:
+            return "SKIPPED"
+    
+    # Build rich metadata
+    glyph_metadata = {glyph: GLYPH_META_CACHE[glyph] for glyph in glyphstream}
+    
+    # Update metadata
+    note.metadata.update({
+        'glyphstream': glyphstream,
+        'glyph_metadata': glyph_metadata,
+        'last_processed': datetime.datetime.now().isoformat(),
+        'stream_type': 'personal' if is_personal else 'shared'
+    })
+    
+    # Write back to file
+    if write_obsidian_file(md_file, note.metadata, read_note_body(note)):
+        print(f"  ✅ {md_file.name}: {', '.join(glyphstream)}")
+        return "UPDATED"
+    return "WRITE_FAILED"
+
 # ======================
 # MAIN PROCESSING LOOP
 # ======================
-def process_vault():
-    """Main function to process all markdown files in the vault"""
-    # Initialize LLM and logging
-    llm = initialize_llm()
-    if not LOG_FILE.exists():
-        LOG_FILE.write_text("")  # Create empty log file
-    
-    print(f"\n🔮 Starting Auto-Glyph processing for vault: {VAULT_PATH}")
-    processed_files = 0
-    start_time = time.time()
+def iter_markdown_files(root: Path) -> Iterator[Path]:
+    """Walk the vault with os.scandir, yielding markdown files outside EXCLUDE_DIRS"""
+    pending = [os.fspath(root)]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in EXCLUDE_DIRS:
+                            pending.append(entry.path)
+                    elif entry.name.endswith(".md") and entry.is_file(follow_symlinks=False):
+                        yield Path(entry.path)
+        except OSError as e:
+            print(f"Cannot scan directory: {str(e)}")
+
+def load_note(md_file: Path) -> Tuple[Optional[str], Optional[Note]]:
+    """Load a note that still needs glyphs, or return the log action for skipping it"""
+    # Cheap triage first: tiny files and already-tagged frontmatter never need a YAML parse
+    with open(md_file, "rb") as f:
+        head = f.read(FRONTMATTER_PEEK_BYTES)
+    if head.startswith(b"---"):
+        end = head.find(b"\n---", 3)
+        if end != -1 and b"\nglyphstream:" in head[:end]:
+            return "SKIPPED", None
+    if len(head) < MIN_NOTE_BYTES:  # Whole file was read, so this is its size
+        return "NO_MATCH", None
     
-    for md_file in VAULT_PATH.rglob("*.md"):
+    note = read_note(md_file)
+    # Skip if already processed (unless --force is added later)
+    if 'glyphstream' in note.metadata:
+        return "SKIPPED", None
+    return None, note
+
+async def read_notes(paths: Iterable[Path], notes: asyncio.Queue, log: BinaryIO, run_id: str):
+    """Load notes from disk and queue those that still need glyphs"""
+    for md_file in paths:
         try:
             # Load existing note
-            post = frontmatter.load(md_file)
-            
-            # Skip if already processed (unless --force is added later)
-            if 'glyphstream' in post.metadata:
-                log_assignment(md_file.name, [], "SKIPPED")
-                continue
-                
-            print(f"Analyzing: {md_file.name}")
-            
-            # Determine stream type
-            is_personal = "shared_experience" not in post.metadata.get("tags", [])
-            glyphstream = llm_assign_glyphs(llm, post.content, is_personal)
-            
-            if glyphstream:
-                # Build rich metadata
-                glyph_metadata = {
-                    glyph: {
-                        "name": GLYPH_LEXICON[glyph]["name"],
-                        "meanings": GLYPH_LEXICON[glyph]["meanings"],
-                        "archetypes": GLYPH_LEXICON[glyph]["archetypes"],
-                        "requires_permission": GLYPH_LEXICON[glyph]["requires_permission"]
-                    } for glyph in glyphstream
-                }
-                
-                # Update metadata
-                post.metadata.update({
-                    'glyphstream': glyphstream,
-                    'glyph_metadata': glyph_metadata,
-                    'last_processed': datetime.datetime.now().isoformat(),
-                    'stream_type': 'personal' if is_personal else 'shared'
-                })
-                
-                # Write back to file
-                if write_obsidian_file(md_file, post.metadata, post.content):
-                    log_assignment(md_file.name, glyphstream, "UPDATED")
-                    print(f"  ✅ Assigned: {', '.join(glyphstream)}")
-                    processed_files += 1
-                else:
-                    log_assignment(md_file.name, glyphstream, "WRITE_FAILED")
-            else:
-                log_assignment(md_file.name, [], "NO_MATCH")
+            action, note = await asyncio.to_thread(load_note, md_file)
+        except Exception as e:
+            error_msg = f"{type(e).__name__}: {str(e)}"
+            log_assignment(log, run_id, md_file.name, [], "ERROR", error_msg)
+            print(f"  ❌ Failed: {error_msg}")
+            continue
+        
+        if action:
+            log_assignment(log, run_id, md_file.name, [], action)
+            continue
+        
+        await notes.put((md_file, note))
+    await notes.put(None)
+
+async def analyze_one(executor: ThreadPoolExecutor, llm_pool: "queue.Queue[Llama]", md_file: Path, note: Note, throttle_ms: int):
+    """Analyze one note on the LLM executor; returns it with its result or exception"""
+    loop = asyncio.get_running_loop()
+    try:
+        outcome = await loop.run_in_executor(executor, analyze_note, llm_pool, note, throttle_ms)
+    except Exception as e:
+        outcome = e
+    return md_file, note, outcome
+
+async def analyze_notes(notes: asyncio.Queue, results: asyncio.Queue, llm_pool: "queue.Queue[Llama]", throttle_ms: int):
+    """Pull batches of loaded notes and analyze them concurrently"""
+    # One thread per Llama instance: extra threads would only block on the pool
+    # while holding default-executor slots that note loading and writing need
+    executor = ThreadPoolExecutor(max_workers=llm_pool.qsize())
+    try:
+        while True:
+            # Take whatever is ready, up to BATCH_SIZE, without waiting for a full batch
+            item = await notes.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) == BATCH_SIZE or notes.empty():
+                    break
+                item = notes.get_nowait()
             
-            time.sleep(0.3)  # Rate limiting
+            if batch:
+                for md_file, _ in batch:
+                    print(f"Analyzing: {md_file.name}")
+                # Hand each note to the writer as soon as it is done, not when the batch is
+                for finished in asyncio.as_completed(
+                    [analyze_one(executor, llm_pool, md_file, note, throttle_ms) for md_file, note in batch]
+                ):
+                    await results.put(await finished)
             
+            if item is None:
+                break
+    finally:
+        executor.shutdown()
+    await results.put(None)
+
+async def write_results(results: asyncio.Queue, log: BinaryIO, run_id: str) -> int:
+    """Write analyzed notes back to disk and log the outcome; returns files updated"""
+    processed_files = 0
+    while (item := await results.get()) is not None:
+        md_file, note, outcome = item
+        try:
+            if isinstance(outcome, Exception):
+                raise outcome
+            glyphstream, is_personal = outcome
+            action = await asyncio.to_thread(record_glyphs, md_file, note, glyphstream, is_personal)
+            # A note found already tagged on re-read was left alone, so log no glyphs for it
+            logged_glyphs = [] if action == "SKIPPED" else glyphstream
+            log_assignment(log, run_id, md_file.name, logged_glyphs, action)
+            if action == "UPDATED":
+                processed_files += 1
         except Exception as e:
             error_msg = f"{type(e).__name__}: {str(e)}"
-            log_assignment(md_file.name, [], "ERROR", error_msg)
+            log_assignment(log, run_id, md_file.name, [], "ERROR", error_msg)
             print(f"  ❌ Failed: {error_msg}")
+    return processed_files
+
+async def run_pipeline(llm_pool: "queue.Queue[Llama]", paths: Iterable[Path], log: BinaryIO, run_id: str, throttle_ms: int = 0) -> int:
+    """Overlap note loading, LLM analysis and file writes; returns files updated"""
+    notes = asyncio.Queue(maxsize=NOTE_QUEUE_SIZE)
+    results = asyncio.Queue()
+    _, _, processed_files = await asyncio.gather(
+        read_notes(paths, notes, log, run_id),
+        analyze_notes(notes, results, llm_pool, throttle_ms),
+        write_results(results, log, run_id)
+    )
+    return processed_files
+
+class QueueLog:
+    """File-like log target that forwards encoded entries to the process writing LOG_FILE"""
+    def __init__(self, log_queue):
+        self.log_queue = log_queue
+    
+    def write(self, data: bytes):
+        self.log_queue.put(data)
+
+def drain_log_queue(log_queue):
+    """Append entries sent by shard workers to LOG_FILE until a None sentinel arrives"""
+    with open(LOG_FILE, "ab", buffering=LOG_BUFFER_BYTES) as log:
+        for data in iter(log_queue.get, None):
+            log.write(data)
+
+def process_shard(paths: List[Path], shard_index: int, run_id: str, throttle_ms: int, log_queue) -> Tuple[int, Dict[str, List[str]]]:
+    """Worker entry point: analyze one shard of the vault with its own Llama instances"""
+    # Pin each worker to a single GPU only when there are several to spread across
+    llm_pool = initialize_llm_pool(main_gpu=shard_index % NUM_GPUS if NUM_GPUS > 1 else None)
+    load_assignment_cache()
+    known = set(_ASSIGNMENT_CACHE)
+    processed_files = asyncio.run(run_pipeline(llm_pool, paths, QueueLog(log_queue), run_id, throttle_ms))
+    # Hand back only new assignments; the parent already holds everything loaded from disk
+    return processed_files, {k: v for k, v in _ASSIGNMENT_CACHE.items() if k not in known}
+
+def process_sharded(workers: int, run_id: str, throttle_ms: int) -> int:
+    """Split the vault across worker processes; returns files updated"""
+    paths = list(iter_markdown_files(VAULT_PATH))
+    # Empty shards would still load a full set of models, so drop them
+    shards = [shard for shard in (paths[i::workers] for i in range(workers)) if shard]
+    if not shards:
+        return 0
+    
+    # Spawn, not fork: each worker sets up its own CUDA state, and forking a
+    # process that already runs threads (Manager, log writer) can deadlock
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Manager() as manager:
+        # Workers only enqueue log lines; a single writer here keeps JSONL appends whole
+        log_queue = manager.Queue()
+        with ctx.Pool(len(shards)) as pool:
+            pending = pool.starmap_async(
+                process_shard,
+                [(shard, i, run_id, throttle_ms, log_queue) for i, shard in enumerate(shards)]
+            )
+            log_writer = threading.Thread(target=drain_log_queue, args=(log_queue,))
+            log_writer.start()
+            try:
+                shard_results = pending.get()
+            finally:
+                log_queue.put(None)
+                log_writer.join()
+    
+    processed_files = 0
+    for shard_processed, shard_cache in shard_results:
+        processed_files += shard_processed
+        _ASSIGNMENT_CACHE.update(shard_cache)
+    return processed_files
+
+def process_vault(throttle_ms: int = 0, workers: int = SHARD_WORKERS):
+    """Main function to process all markdown files in the vault"""
+    load_assignment_cache()
+    
+    print(f"\n🔮 Starting Auto-Glyph processing for vault: {VAULT_PATH}")
+    start_time = time.time()
+    run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")  # Same for every entry this run
+    
+    try:
+        if workers > 1:
+            processed_files = process_sharded(workers, run_id, throttle_ms)
+        else:
+            llm_pool = initialize_llm_pool()
+            # One buffered append handle for the whole run (created if missing)
+            with open(LOG_FILE, "ab", buffering=LOG_BUFFER_BYTES) as log:
+                processed_files = asyncio.run(
+                    run_pipeline(llm_pool, iter_markdown_files(VAULT_PATH), log, run_id, throttle_ms)
+                )
+    finally:
+        save_assignment_cache()
     
     # Final report
     duration = time.time() - start_time
@@ -264,4 +702,10 @@ def process_vault():
     print(f"- Log file: {LOG_FILE}")
 
 if __name__ == "__main__":
-    process_vault()
+    parser = argparse.ArgumentParser(description="Assign glyphs to notes in an Obsidian vault")
+    parser.add_argument("--throttle-ms", type=int, default=0,
+                        help="Pause after each LLM call, in milliseconds (default: 0)")
+    parser.add_argument("--workers", type=int, default=SHARD_WORKERS,
+                        help=f"Processes to shard the vault across, each with its own LLM (default: {SHARD_WORKERS})")
+    args = parser.parse_args()
+    process_vault(throttle_ms=args.throttle_ms, workers=args.workers)